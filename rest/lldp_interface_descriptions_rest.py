@@ -16,9 +16,19 @@ The '(DOWN)' string indicates an LLDP neighbor which was previously
 present, but is now not present.
 """
 
+import os
+import re
 import sys
+import json
+import time
 import email
+import Queue
+import fnmatch
 import getpass
+import hashlib
+import argparse
+import threading
+import contextlib
 
 import requests
 import jxmlease
@@ -26,19 +36,163 @@ import jxmlease
 # Should be set appropriately for the network environment.
 SCHEME = 'http'
 PORT = 3000
+REQUEST_TIMEOUT = 60
 
 SINGLE_RPC_URL_FORMAT = SCHEME + '://%s:' + str(PORT) + '/rpc/%s@format=%s'
 MULTIPLE_RPC_URL_FORMAT = SCHEME + '://%s:' + str(PORT) + '/rpc'
 
+# Inventory group processed when --inventory is given without --limit.
+DEFAULT_GROUP = 'junos-all'
+
+# Matches the first host range, such as '[1:3]', in an inventory host pattern.
+HOST_RANGE_RE = re.compile(r'^(.*?)\[([0-9]+|[a-z]):([0-9]+|[a-z])'
+                           r'(?::([0-9]+))?\](.*)$')
+
+# Statuses in the results file of devices which --resume does not process
+# again.
+FINISHED_STATUSES = ('committed', 'unchanged')
+
+# Adaptive concurrency limits, given as (initial, minimum, maximum).
+# Read RPCs and commits are limited separately. A limit grows by one for
+# each window of RPCs which complete within its latency target
+# (READ_LATENCY_TARGET or COMMIT_LATENCY_TARGET seconds), and is multiplied
+# by BACKOFF_FACTOR when a device times out or returns an HTTP 5xx error.
+MAX_WORKERS = 32
+READ_LIMITS = (4, 1, 32)
+COMMIT_LIMITS = (2, 1, 8)
+READ_LATENCY_TARGET = 5.0
+COMMIT_LATENCY_TARGET = 30.0
+BACKOFF_FACTOR = 0.5
+
 # Create a jxmlease parser with desired defaults.
 parser = jxmlease.Parser()
 
 
+class DeviceError(Exception):
+    """An error processing a device. The message describes the error."""
+
+
+class AIMDLimiter(object):
+    """Additive-increase/multiplicative-decrease concurrency limiter.
+
+    Each change to the limit is recorded in the history attribute as an
+    (elapsed seconds, limit) tuple.
+    """
+
+    def __init__(self, name, initial, minimum, maximum, latency_target):
+        self.name = name
+        self.latency_target = latency_target
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.start_time = time.time()
+        self.last_backoff = self.start_time
+        self.history = [(0.0, initial)]
+        self.cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Wait for a free slot and hold it for the enclosed operation.
+
+        The time spent waiting is added to slot_wait.seconds for the
+        current thread.
+        """
+        wait_start = time.time()
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+        start = time.time()
+        slot_wait.seconds = (getattr(slot_wait, 'seconds', 0.0) +
+                             start - wait_start)
+        try:
+            yield
+        except Exception as err:
+            self._release(start, overloaded=is_overload_error(err))
+            raise
+        self._release(start, overloaded=False)
+
+    def _release(self, start, overloaded):
+        with self.cond:
+            self.in_flight -= 1
+            old_limit = int(self.limit)
+            if overloaded:
+                # Back off only once for a burst of failures from
+                # operations which were already in flight.
+                if start >= self.last_backoff:
+                    self.limit = max(self.minimum,
+                                     self.limit * BACKOFF_FACTOR)
+                    self.last_backoff = time.time()
+            elif time.time() - start <= self.latency_target:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            if int(self.limit) != old_limit:
+                self.history.append((time.time() - self.start_time,
+                                     int(self.limit)))
+            self.cond.notify_all()
+
+
+class ResultLog(object):
+    """Append-only log of per-device results in JSON Lines format.
+
+    Each result is appended to the file at path (if any) and flushed to
+    disk as soon as the device completes, so an interrupted run can be
+    resumed. Only a count of each status is kept in memory.
+    """
+
+    def __init__(self, path=None):
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.file = None
+        if path:
+            # Terminate a final line truncated by an interrupted run.
+            truncated = False
+            if os.path.exists(path) and os.path.getsize(path) > 0:
+                with open(path, 'rb') as results:
+                    results.seek(-1, os.SEEK_END)
+                    truncated = results.read(1) != '\n'
+            self.file = open(path, 'a')
+            if truncated:
+                self.file.write('\n')
+
+    def write(self, result):
+        with self.lock:
+            status = result['status']
+            self.counts[status] = self.counts.get(status, 0) + 1
+            if self.file:
+                self.file.write(json.dumps(result, sort_keys=True) + '\n')
+                self.file.flush()
+                os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+read_limiter = AIMDLimiter('Read RPC', *READ_LIMITS,
+                           latency_target=READ_LATENCY_TARGET)
+commit_limiter = AIMDLimiter('Commit', *COMMIT_LIMITS,
+                             latency_target=COMMIT_LATENCY_TARGET)
+
+# Each worker thread buffers the messages for its current device in
+# device_output.lines, and prints them as one block when the device is done.
+device_output = threading.local()
+print_lock = threading.Lock()
+
+# Total seconds each thread has spent waiting for AIMDLimiter slots.
+slot_wait = threading.local()
+
+
 def main():
     """The main loop.
 
+    Build the device list from the command line and the inventory files,
+    keeping only the devices assigned to this run's shard. With --resume,
+    skip the devices already finished in the results file.
     Prompt for a username and password.
-    Loop over each device specified on the command line.
+    Process each device in a pool of worker threads. The number of
+    simultaneous read RPCs and commits is adapted to the devices' response
+    times.
     Perform the following steps on each device:
     1) Get LLDP information from the current device state.
     2) Get interface descriptions from the device configuration.
@@ -46,67 +200,443 @@ def main():
        information stored in the interface descriptions. Print changes.
     4) Build a configuration snippet with new interface descriptions.
     5) Commit the configuration changes.
+    Append the result for each device to the results file as it completes.
+    Print the concurrency limits chosen over the course of the run.
 
     Return an integer suitable for passing to sys.exit().
     """
 
-    if len(sys.argv) == 1:
-        print("\nUsage: %s device1 [device2 [...]]\n\n" % sys.argv[0])
+    args = parse_args()
+    if not args.devices and not args.inventory:
+        print("\nUsage: %s device1 [device2 [...]]\n"
+              "       %s -i inventory [-l pattern] [--shard-count N "
+              "--shard-index K]\n\n" % (sys.argv[0], sys.argv[0]))
         return 1
 
-    rc = 0
+    hostnames = get_hostnames(args)
+    if hostnames == None:
+        print("No devices in %s match %s." %
+              (", ".join(args.inventory),
+               ", ".join(args.limit or [DEFAULT_GROUP])))
+        return 1
+    print("Shard %d of %d: %d devices." %
+          (args.shard_index, args.shard_count, len(hostnames)))
+    if args.resume:
+        finished = read_finished_devices(args.results)
+        hostnames = [hostname for hostname in hostnames
+                     if hostname not in finished]
+        print("Resuming: %d devices left to process." % len(hostnames))
+    if not hostnames:
+        return 0
 
     # Get username and password as user input.
     user = raw_input('Device Username: ')
     password = getpass.getpass('Device Password: ')
 
-    for hostname in sys.argv[1:]:
-        print("Getting LLDP information from %s..." % hostname)
-        lldp_info = get_lldp_neighbors(device=hostname,
-                                       user=user,
-                                       pw=password)
-        if not lldp_info:
-            if lldp_info == None:
-                print("    Error retrieving LLDP info on " + hostname +
-                      ". Make sure LLDP is enabled.")
+    queue = Queue.Queue()
+    for hostname in hostnames:
+        queue.put(hostname)
+
+    result_log = ResultLog(args.results)
+    workers = []
+    for _ in range(min(MAX_WORKERS, len(hostnames))):
+        worker = threading.Thread(target=device_worker,
+                                  args=(queue, result_log, user, password))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    # Join with a timeout, so KeyboardInterrupt is delivered to the main
+    # thread while the workers are running.
+    for worker in workers:
+        while worker.is_alive():
+            worker.join(1)
+    result_log.close()
+
+    print_limit_history(read_limiter)
+    print_limit_history(commit_limiter)
+    print("Results: " + ", ".join("%d %s" % (count, status) for
+                                  (status, count) in
+                                  sorted(result_log.counts.items())))
+    return 1 if result_log.counts.get('error') else 0
+
+
+def parse_args():
+    """Parse the command line arguments.
+
+    Return an argparse.Namespace.
+    """
+
+    arg_parser = argparse.ArgumentParser(
+        description='Use interface descriptions to track the topology '
+                    'reported by LLDP.'
+    )
+    arg_parser.add_argument('devices', metavar='device', nargs='*',
+                            help='device hostname')
+    arg_parser.add_argument('-i', '--inventory', action='append',
+                            default=[],
+                            help='Ansible INI inventory file (may be '
+                                 'repeated)')
+    arg_parser.add_argument('-l', '--limit', action='append', default=[],
+                            help='group or host pattern selecting devices '
+                                 'from the inventory; shell-style wildcards '
+                                 'are allowed and a leading "!" excludes '
+                                 '(may be repeated, default: %s)' %
+                                 DEFAULT_GROUP)
+    arg_parser.add_argument('--shard-count', type=int, default=1,
+                            help='number of shards the devices are split '
+                                 'into (default: 1)')
+    arg_parser.add_argument('--shard-index', type=int, default=0,
+                            help='shard processed by this run, from 0 to '
+                                 'SHARD_COUNT - 1 (default: 0)')
+    arg_parser.add_argument('-o', '--results',
+                            help='append a JSON line with the result of '
+                                 'each device to this file')
+    arg_parser.add_argument('--resume', action='store_true',
+                            help='skip devices already finished in the '
+                                 'results file')
+    args = arg_parser.parse_args()
+    if args.resume and not args.results:
+        arg_parser.error('--resume requires --results')
+    if args.limit and not args.inventory:
+        arg_parser.error('--limit requires --inventory')
+    if args.shard_count < 1:
+        arg_parser.error('--shard-count must be at least 1')
+    if not 0 <= args.shard_index < args.shard_count:
+        arg_parser.error('--shard-index must be between 0 and %d' %
+                         (args.shard_count - 1))
+    return args
+
+
+def get_hostnames(args):
+    """Build the list of devices to be processed by this run.
+
+    Combine the devices given on the command line with the devices selected
+    from the inventory files, then keep only the devices which hash to this
+    run's shard.
+
+    Return a sorted list of hostnames. If inventory files were given but
+    the patterns select no devices from them, print a warning and continue
+    with the command line devices, or return None if there are none.
+    """
+
+    hostnames = set(args.devices)
+    if args.inventory:
+        (hosts, children) = ({}, {})
+        for path in args.inventory:
+            read_inventory(path, hosts, children)
+        selected = select_hosts(expand_groups(hosts, children),
+                                args.limit or [DEFAULT_GROUP])
+        if not selected:
+            if not hostnames:
+                return None
+            print("Warning: No devices in %s match %s." %
+                  (", ".join(args.inventory),
+                   ", ".join(args.limit or [DEFAULT_GROUP])))
+        hostnames.update(selected)
+    return sorted(hostname for hostname in hostnames
+                  if in_shard(hostname, args.shard_index, args.shard_count))
+
+
+def read_inventory(path, hosts, children):
+    """Read an Ansible INI-format inventory file.
+
+    Host ranges such as 'edge[1:3].site1' are expanded. Hosts listed
+    before the first section belong to the 'ungrouped' group. [group:vars]
+    sections are ignored.
+
+    Add the hosts of each group to the hosts dictionary, and the child
+    groups of each [group:children] section to the children dictionary.
+    Both map a group name to a set, and may already hold the contents of
+    other inventory files.
+    """
+
+    hosts.setdefault('ungrouped', set())
+    (group, kind) = ('ungrouped', 'hosts')
+    with open(path) as inventory:
+        for line in inventory:
+            line = line.strip()
+            if not line or line.startswith(('#', ';')):
+                continue
+            if line.startswith('[') and line.endswith(']'):
+                (group, _, kind) = line[1:-1].partition(':')
+                kind = kind or 'hosts'
+                hosts.setdefault(group, set())
+                continue
+            if kind == 'hosts':
+                hosts[group].update(expand_host_range(line.split()[0]))
+            elif kind == 'children':
+                children.setdefault(group, set()).add(line.split()[0])
+
+
+def expand_groups(hosts, children):
+    """Resolve the child groups read by read_inventory().
+
+    Every host is also a member of the implicit 'all' group.
+
+    Return a dictionary mapping each group name to the set of hostnames in
+    the group and all of its descendant groups.
+    """
+
+    def members(group, seen):
+        result = set(hosts.get(group, ()))
+        for child in children.get(group, ()):
+            if child not in seen:
+                result |= members(child, seen | set([child]))
+        return result
+
+    groups = dict((group, members(group, set([group])))
+                  for group in set(hosts) | set(children))
+    groups['all'] = set()
+    for group_hosts in hosts.values():
+        groups['all'] |= group_hosts
+    return groups
+
+
+def expand_host_range(pattern):
+    """Expand an Ansible host range pattern.
+
+    For example, 'edge[1:3].site1' expands to
+    ['edge1.site1', 'edge2.site1', 'edge3.site1']. Numeric ranges keep
+    leading zeros ('[01:10]'), alphabetic ranges ('[a:f]') and an optional
+    stride ('[1:9:2]') are also supported.
+
+    Return a list of hostnames.
+    """
+
+    match = HOST_RANGE_RE.match(pattern)
+    if not match:
+        return [pattern]
+    (head, beg, end, stride, tail) = match.groups()
+    stride = int(stride) if stride else 1
+    if beg.isdigit() and end.isdigit():
+        seq = ['%0*d' % (len(beg), i)
+               for i in range(int(beg), int(end) + 1, stride)]
+    else:
+        seq = [chr(i) for i in range(ord(beg), ord(end) + 1, stride)]
+    hostnames = []
+    for value in seq:
+        hostnames.extend(expand_host_range(head + value + tail))
+    return hostnames
+
+
+def select_hosts(groups, patterns):
+    """Select hosts from inventory groups using Ansible-style patterns.
+
+    Each pattern is matched with shell-style wildcards against both group
+    names and hostnames. Patterns starting with '!' remove matching hosts
+    from the selection.
+
+    Return a set of hostnames.
+    """
+
+    all_hosts = set()
+    for members in groups.values():
+        all_hosts |= members
+
+    def matches(pattern):
+        result = set(fnmatch.filter(all_hosts, pattern))
+        for group in fnmatch.filter(groups, pattern):
+            result |= groups[group]
+        return result
+
+    selected = set()
+    for pattern in patterns:
+        if not pattern.startswith('!'):
+            selected |= matches(pattern)
+    for pattern in patterns:
+        if pattern.startswith('!'):
+            selected -= matches(pattern[1:])
+    return selected
+
+
+def in_shard(hostname, shard_index, shard_count):
+    """Check whether a device belongs to a shard.
+
+    Devices are assigned using rendezvous (highest random weight) hashing,
+    so every run computes the same assignment without coordination, and
+    changing the number of shards only moves the devices of the added or
+    removed shards.
+
+    Return True if hostname is assigned to shard_index.
+    """
+
+    def weight(shard):
+        return hashlib.md5('%d:%s' % (shard, hostname)).hexdigest()
+
+    return max(range(shard_count), key=weight) == shard_index
+
+
+def read_finished_devices(path):
+    """Read the devices already finished from a results file.
+
+    The last result recorded for each device wins. Lines which cannot be
+    parsed, such as a line truncated by an interrupted run, are ignored.
+
+    Return a set of hostnames whose status is in FINISHED_STATUSES.
+    """
+
+    finished = set()
+    if not os.path.exists(path):
+        return finished
+    with open(path) as results:
+        for line in results:
+            try:
+                result = json.loads(line)
+                (hostname, status) = (result['device'], result['status'])
+            except (ValueError, KeyError, TypeError):
+                continue
+            if status in FINISHED_STATUSES:
+                finished.add(hostname)
             else:
-                print("    No LLDP neighbors on " + hostname +
-                      ". Make sure LLDP is enabled.")
-            rc = 1
-            continue
+                finished.discard(hostname)
+    return finished
 
-        print("Getting interface descriptions from %s..." % hostname)
-        desc_info = get_description_info_for_interfaces(device=hostname,
-                                                        user=user,
-                                                        pw=password)
-        if desc_info == None:
-            print("    Error retrieving interface descriptions on %s." %
-                  hostname)
-            rc = 1
-            continue
 
-        desc_changes = check_lldp_changes(lldp_info, desc_info)
+def device_worker(hostnames, result_log, user, password):
+    """Process devices from the hostnames queue until it is empty.
+
+    Write the result of process_device() for each device to result_log,
+    and print the device's messages as one block. An unexpected exception
+    is recorded as an error result for the device.
+    """
+
+    while True:
+        try:
+            hostname = hostnames.get_nowait()
+        except Queue.Empty:
+            return
+        device_output.lines = []
+        try:
+            result = process_device(hostname, user, password)
+        except Exception as err:
+            # An unexpected error must not kill the worker thread, or the
+            # device would be left without a result.
+            log("    Unexpected error on %s: %s" % (hostname, repr(err)))
+            result = {'device': hostname,
+                      'status': 'error',
+                      'error': repr(err)}
+        finally:
+            with print_lock:
+                print("\n".join(device_output.lines))
+            device_output.lines = None
+        result_log.write(result)
+
+
+def process_device(hostname, user, password):
+    """Sync the LLDP interface descriptions on a single device.
+
+    Return a result dictionary for the ResultLog. 'status' is 'committed',
+    'unchanged', or 'error'; 'error' describes the error; 'step' is the
+    last step attempted; 'events' lists the LLDP events found by
+    check_lldp_changes(); 'timings' holds the seconds spent in each step,
+    excluding 'slot_waits', the seconds spent waiting for a concurrency
+    limiter slot.
+    """
+
+    result = {'device': hostname,
+              'status': 'error',
+              'events': [],
+              'timings': {},
+              'slot_waits': {},
+              'started': time.time()}
+    try:
+        log("Getting LLDP information from %s..." % hostname)
+        with timed_step(result, 'lldp'):
+            lldp_info = get_lldp_neighbors(device=hostname,
+                                           user=user,
+                                           pw=password)
+        if not lldp_info:
+            raise DeviceError("No LLDP neighbors. Make sure LLDP is enabled.")
+
+        log("Getting interface descriptions from %s..." % hostname)
+        with timed_step(result, 'descriptions'):
+            desc_info = get_description_info_for_interfaces(device=hostname,
+                                                            user=user,
+                                                            pw=password)
+
+        desc_changes = check_lldp_changes(lldp_info, desc_info,
+                                          result['events'])
         if not desc_changes:
-            print("    No LLDP changes to configure on %s." % hostname)
-            continue
+            log("    No LLDP changes to configure on %s." % hostname)
+            result['status'] = 'unchanged'
+            return result
 
         config = build_config_changes(desc_changes)
         if config == None:
-            print("    Error generating configuration changes for %s." %
-                  hostname)
-            rc = 1
-            continue
+            raise DeviceError("Error generating configuration changes.")
+
+        with timed_step(result, 'commit'):
+            load_merge_xml_config(device=hostname,
+                                  user=user,
+                                  pw=password,
+                                  config=config)
+        log("    Successfully committed configuration changes on %s." %
+            hostname)
+        result['status'] = 'committed'
+    except DeviceError as err:
+        log("    Error on %s: %s" % (hostname, err))
+        result['error'] = str(err)
+    except requests.exceptions.RequestException as err:
+        log("    Error communicating with %s: %s" % (hostname, repr(err)))
+        result['error'] = repr(err)
+    finally:
+        result['elapsed'] = round(time.time() - result['started'], 3)
+    return result
+
+
+@contextlib.contextmanager
+def timed_step(result, step):
+    """Record step as the current step of result, and time it.
+
+    Time spent waiting for a concurrency limiter slot is recorded in
+    result['slot_waits'] rather than result['timings'].
+    """
 
-        if load_merge_xml_config(device=hostname,
-                                 user=user,
-                                 pw=password,
-                                 config=config):
-            print("    Successfully committed configuration changes on %s." %
-                  hostname)
-        else:
-            print("    Error committing description changes on %s." % hostname)
-            rc = 1
-    return rc
+    result['step'] = step
+    waited = getattr(slot_wait, 'seconds', 0.0)
+    start = time.time()
+    try:
+        yield
+    finally:
+        waited = getattr(slot_wait, 'seconds', 0.0) - waited
+        result['slot_waits'][step] = round(waited, 3)
+        result['timings'][step] = round(time.time() - start - waited, 3)
+
+
+def log(message):
+    """Print a message, or buffer it while a worker processes a device."""
+
+    lines = getattr(device_output, 'lines', None)
+    if lines is None:
+        print(message)
+    else:
+        lines.append(message)
+
+
+def print_limit_history(limiter):
+    """Print each concurrency limit chosen by an AIMDLimiter."""
+
+    print("%s concurrency limit over time:" % limiter.name)
+    for (elapsed, limit) in limiter.history:
+        print("    %8.1fs  %d" % (elapsed, limit))
+
+
+def is_overload_error(err):
+    """Check whether an exception indicates an overloaded device.
+
+    Connect and read timeouts and HTTP 5xx responses are treated as
+    overload. Other errors, such as authentication failures or unknown
+    hostnames, do not affect the concurrency limits.
+
+    Return True if the concurrency limits should back off.
+    """
+
+    if isinstance(err, requests.exceptions.Timeout):
+        return True
+    if isinstance(err, requests.exceptions.HTTPError):
+        return (err.response is not None and
+                err.response.status_code >= 500)
+    return False
 
 
 def get_lldp_neighbors(device, user, pw):
@@ -115,7 +645,7 @@ def get_lldp_neighbors(device, user, pw):
     Return a two-level dictionary with the LLDP neighbor information..
     The first-level key is the local port (aka interface) name.
     The second-level keys are 'system' for the remote system name
-    and 'port' for the remote port ID. On error, return None.
+    and 'port' for the remote port ID. On error, raise DeviceError.
 
     For example:
     {'ge-0/0/1': {'system': 'r1', 'port', 'ge-0/0/10'}}
@@ -125,13 +655,15 @@ def get_lldp_neighbors(device, user, pw):
                                    'get-lldp-neighbors-information',
                                    'json')
 
-    http_resp = requests.get(url, auth=(user,pw))
-    http_resp.raise_for_status()
+    with read_limiter.slot():
+        http_resp = requests.get(url, auth=(user,pw), timeout=REQUEST_TIMEOUT)
+        http_resp.raise_for_status()
 
     # Check for an XML error message.
     if http_resp.headers['Content-Type'].startswith('application/xml'):
-        _ = check_for_warnings_and_errors(parser(http_resp.text))
-        return None
+        (errors, _) = check_for_warnings_and_errors(parser(http_resp.text))
+        raise DeviceError("Error retrieving LLDP info: %s" %
+                          ("; ".join(errors) or "(no error message)"))
 
     resp = http_resp.json()
     
@@ -139,7 +671,8 @@ def get_lldp_neighbors(device, user, pw):
     try:
         ni = resp['lldp-neighbors-information'][0]['lldp-neighbor-information']
     except KeyError:
-        return None
+        raise DeviceError("Error retrieving LLDP info. "
+                          "Make sure LLDP is enabled.")
 
     for nbr in ni:
         try:
@@ -149,7 +682,7 @@ def get_lldp_neighbors(device, user, pw):
             lldp_info[local_port] = {'system': remote_system,
                                      'port': remote_port}
         except KeyError:
-            return None
+            raise DeviceError("Error parsing LLDP neighbor information.")
 
     return lldp_info
 
@@ -164,7 +697,8 @@ def get_description_info_for_interfaces(device, user, pw):
     local port (aka interface) name. The second-level keys are
     'user_desc' for the user-configured description, 'system' for the
     remote system name, 'port' for the remote port, and 'down', which is
-    a Boolean indicating if LLDP was previously down. On error, return None.
+    a Boolean indicating if LLDP was previously down. On error, raise
+    DeviceError.
 
     For example:
     {'ge-0/0/1': {'user_desc': 'test description', 'system': 'r1',
@@ -173,16 +707,18 @@ def get_description_info_for_interfaces(device, user, pw):
 
     url = SINGLE_RPC_URL_FORMAT % (device, 'get-interface-information', 'xml')
 
-    http_resp = requests.get(url,
-                             auth=(user, pw),
-                             params={'descriptions': ''},
-                             stream=True)
-    http_resp.raise_for_status()
-    resp = parser(http_resp.raw)
+    with read_limiter.slot():
+        http_resp = requests.get(url,
+                                 auth=(user, pw),
+                                 params={'descriptions': ''},
+                                 timeout=REQUEST_TIMEOUT)
+        http_resp.raise_for_status()
+    resp = parser(http_resp.text)
 
-    (error_count, warning_count) = check_for_warnings_and_errors(resp)
-    if error_count > 0:
-        return None
+    (errors, _) = check_for_warnings_and_errors(resp)
+    if errors:
+        raise DeviceError("Error retrieving interface descriptions: %s" %
+                          "; ".join(errors))
 
     desc_info = {}
     try: 
@@ -208,38 +744,36 @@ def get_description_info_for_interfaces(device, user, pw):
 def check_for_warnings_and_errors(root):
     """Check a jxmlease.XMLDictNode for warnings and errors.
 
-    Prints the warning or error message.
+    Prints the warning messages. The caller reports the error messages.
     (Note: Ignores the warning:
            'uncommitted changes will be discarded on exit'
            This warning is an expected output of the open-configuration RPC.)
 
-    Returns a tuple of (error_count, warning_count).
+    Returns a tuple of (error_messages, warning_messages).
     """
 
-    error_count = 0
-    warning_count = 0
+    errors = []
+    warnings = []
     for node in root.find_nodes_with_tag(('xnm:warning','xnm:error')):
         msg = node.get('message','(empty message)')
         if node.tag == 'xnm:warning':
             if msg == 'uncommitted changes will be discarded on exit': 
                 continue
-            level = 'Warning'   
-            warning_count += 1
+            log("    Warning: %s" % msg)
+            warnings.append(msg)
         elif node.tag == 'xnm:error':
-            level = 'Error'
-            error_count += 1
-        else:
-            level = 'Unknown'
-        print "    %s: %s" % (level,msg)
-    return (error_count, warning_count)
+            errors.append(msg)
+    return (errors, warnings)
 
 
-def check_lldp_changes(lldp_info, desc_info):
+def check_lldp_changes(lldp_info, desc_info, events=None):
     """Compare current LLDP info with previous snapshot from descriptions.
 
     Given the dictionaries produced by get_lldp_neighbors() and
     get_description_info_for_interfaces(), print LLDP up, change,
-    and down messages.
+    and down messages. If events is a list, also append a dictionary
+    for each message with the 'port', the 'event' ('up', 'change', or
+    'down'), and the 'was' and 'now' [system, port] neighbors.
 
     Return a dictionary containing information for the new descriptions
     to configure.
@@ -260,17 +794,26 @@ def check_lldp_changes(lldp_info, desc_info):
             if not desc_system or not desc_port:
                 has_lldp_desc = False
         if not has_lldp_desc:
-            print("    %s LLDP Up. Now: %s %s" %
+            event = 'up'
+            log("    %s LLDP Up. Now: %s %s" %
                   (local_port,lldp_system,lldp_port))
         elif down:
-            print("    %s LLDP Up. Was: %s %s Now: %s %s" %
+            event = 'up'
+            log("    %s LLDP Up. Was: %s %s Now: %s %s" %
                   (local_port,desc_system,desc_port,lldp_system,lldp_port))
         elif lldp_system != desc_system or lldp_port != desc_port:
-            print("    %s LLDP Change. Was: %s %s Now: %s %s" %
+            event = 'change'
+            log("    %s LLDP Change. Was: %s %s Now: %s %s" %
                   (local_port,desc_system,desc_port,lldp_system,lldp_port))
         else:
             # No change. LLDP was not down. Same system and port.
             continue
+        if events is not None:
+            events.append({'port': local_port,
+                           'event': event,
+                           'was': ([desc_system, desc_port] if has_lldp_desc
+                                   else None),
+                           'now': [lldp_system, lldp_port]})
         desc_changes[local_port] = "LLDP: %s %s" % (lldp_system,lldp_port)
 
     # Iterate through the saved state as retrieved from the interface
@@ -283,8 +826,13 @@ def check_lldp_changes(lldp_info, desc_info):
         down = desc_info[local_port]['down']
         if (desc_system and desc_port and not down and
             not lldp_info.has_key(local_port)):
-            print("    %s LLDP Down. Was: %s %s" %
+            log("    %s LLDP Down. Was: %s %s" %
                   (local_port,desc_system,desc_port))
+            if events is not None:
+                events.append({'port': local_port,
+                               'event': 'down',
+                               'was': [desc_system, desc_port],
+                               'now': None})
             desc_changes[local_port] = "LLDP: %s %s(DOWN)" % (desc_system,
                                                               desc_port)
 
@@ -328,7 +876,7 @@ def load_merge_xml_config(device, user, pw, config):
         commit (and close the configuration),
         and check the results.
 
-    Return True if the config was committed successfully, False otherwise.
+    Raise DeviceError if the config was not committed successfully.
     """
 
     load_config_node = jxmlease.XMLDictNode(config, tag='load-configuration')
@@ -346,31 +894,32 @@ def load_merge_xml_config(device, user, pw, config):
     headers = {'Accept': 'application/xml',
                'Content-Type': 'application/xml'}
     url = MULTIPLE_RPC_URL_FORMAT % (device)
-    http_resp = requests.post(url, auth=(user,pw), params=args,
-                              headers=headers, data=payload_string)
-    http_resp.raise_for_status()
+    with commit_limiter.slot():
+        http_resp = requests.post(url, auth=(user,pw), params=args,
+                                  headers=headers, data=payload_string,
+                                  timeout=REQUEST_TIMEOUT)
+        http_resp.raise_for_status()
 
     responses = parse_multipart_messages(type=http_resp.headers['Content-Type'],
                                          response=http_resp.text)
 
-    rc = True
+    errors = []
 
     if len(responses) != len(rpcs):
-        print "    Error: Fewer responses than expected!"
-        rc = False
+        errors.append("Fewer responses than expected!")
 
     for xml_response in responses:
         if xml_response == None:
-            print "    Error: Unable to parse an RPC response!"
-            rc = False
+            errors.append("Unable to parse an RPC response!")
         else:
-            (error_count, warning_count) = check_for_warnings_and_errors(
+            (rpc_errors, _) = check_for_warnings_and_errors(
                 parser(xml_response)
             )
-            if error_count > 0:
-                rc = False
+            errors.extend(rpc_errors)
 
-    return rc
+    if errors:
+        raise DeviceError("Error committing description changes: %s" %
+                          "; ".join(errors))
 
 
 def parse_multipart_messages(type, response):
@@ -405,7 +954,7 @@ def parse_multipart_messages(type, response):
             (sub_type == 'text/plain' and payload == "")):
             msg_list.append(payload)
         else:
-            print("    Error: Unknown sub message.\n" +
+            log("    Error: Unknown sub message.\n" +
                   "           Type: %s\n" +
                   "           Content: %s" % (sub_type,payload))
             msg_list.append(None)